@@ -0,0 +1,73 @@
+import asyncio
+from typing import List
+import structlog
+
+from .database import SessionLocal, AuditLog
+
+logger = structlog.get_logger()
+
+# Audit entries are queued by request handlers and bulk-inserted in the background
+AUDIT_BATCH_SIZE = 200
+AUDIT_FLUSH_INTERVAL = 0.1
+# Bounds memory if the database falls behind; entries past this are dropped
+AUDIT_QUEUE_SIZE = 10_000
+
+audit_queue: "asyncio.Queue[dict]" = asyncio.Queue(maxsize=AUDIT_QUEUE_SIZE)
+
+# Queued after the last entry to stop the writer without cancelling a write
+_STOP = object()
+
+def enqueue_audit_log(entry: dict):
+    """Queue an audit log row for the background writer, dropping it if the queue is full"""
+    try:
+        audit_queue.put_nowait(entry)
+    except asyncio.QueueFull:
+        logger.warning("Audit queue full, dropping entry",
+                       device_id=entry.get("device_id"), action=entry.get("action"))
+
+async def _write_batch(batch: List[dict]):
+    """Bulk insert a batch of audit log rows"""
+    async with SessionLocal() as db:
+        try:
+            await db.execute(AuditLog.__table__.insert(), batch)
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            logger.error("Failed to write audit logs", count=len(batch), error=str(e))
+
+async def audit_log_writer():
+    """Drain the audit queue in batches of up to AUDIT_BATCH_SIZE or every AUDIT_FLUSH_INTERVAL"""
+    loop = asyncio.get_running_loop()
+    while True:
+        entry = await audit_queue.get()
+        if entry is _STOP:
+            return
+        batch = [entry]
+        stopping = False
+        deadline = loop.time() + AUDIT_FLUSH_INTERVAL
+        try:
+            while len(batch) < AUDIT_BATCH_SIZE:
+                entry = await asyncio.wait_for(audit_queue.get(), deadline - loop.time())
+                if entry is _STOP:
+                    stopping = True
+                    break
+                batch.append(entry)
+        except asyncio.TimeoutError:
+            pass
+        await _write_batch(batch)
+        if stopping:
+            return
+
+async def stop_audit_log_writer(task: asyncio.Task):
+    """Let the writer finish its in-flight batch and exit, then flush what is left"""
+    await audit_queue.put(_STOP)
+    await task
+    await flush_audit_logs()
+
+async def flush_audit_logs():
+    """Write out anything still queued (used on shutdown)"""
+    batch = []
+    while not audit_queue.empty():
+        batch.append(audit_queue.get_nowait())
+    if batch:
+        await _write_batch(batch)
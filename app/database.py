@@ -1,12 +1,28 @@
-from sqlalchemy import create_engine, Column, String, Integer, Boolean, DateTime, Text
+from sqlalchemy import inspect, text, Index, Column, String, Integer, Boolean, DateTime, Text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
 from datetime import datetime
+import time
 from .config import settings
 
+def _async_database_url(url: str) -> str:
+    """Point a plain PostgreSQL URL at the asyncpg driver"""
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    if url.startswith("postgresql://"):
+        return "postgresql+asyncpg://" + url[len("postgresql://"):]
+    return url
+
 # Database setup
-engine = create_engine(settings.database_url, pool_pre_ping=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_async_engine(
+    _async_database_url(settings.database_url),
+    pool_pre_ping=True,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_recycle=settings.db_pool_recycle,
+    pool_timeout=settings.db_pool_timeout
+)
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 # Database Models
@@ -15,7 +31,6 @@ class Device(Base):
     
     device_id = Column(String, primary_key=True, index=True)
     user_id = Column(String, nullable=False)
-    derived_key_hash = Column(String, nullable=False)  # Store hash, not actual key
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     last_used = Column(DateTime, nullable=True)
@@ -24,6 +39,10 @@ class Device(Base):
 
 class AuditLog(Base):
     __tablename__ = "audit_logs"
+    __table_args__ = (
+        # Covers the per-device rate-limit lookup in verify_otp
+        Index("ix_audit_device_action_time", "device_id", "action", "timestamp"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     device_id = Column(String, nullable=False, index=True)
@@ -35,23 +54,45 @@ class AuditLog(Base):
     additional_data = Column(Text, nullable=True)
 
 # Create tables
-def create_tables():
-    Base.metadata.create_all(bind=engine)
+def _relax_legacy_columns(conn):
+    """Databases created before migration 003 still have derived_key_hash NOT NULL,
+    which the model no longer writes; make it nullable so registration keeps working"""
+    legacy = next((c for c in inspect(conn).get_columns("devices") if c["name"] == "derived_key_hash"), None)
+    if legacy is None or legacy["nullable"]:
+        return
+    if conn.dialect.name == "sqlite":
+        # SQLite cannot relax a constraint in place, drop the column as 003 does
+        conn.execute(text("ALTER TABLE devices DROP COLUMN derived_key_hash"))
+    else:
+        conn.execute(text("ALTER TABLE devices ALTER COLUMN derived_key_hash DROP NOT NULL"))
+
+async def create_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_relax_legacy_columns)
 
 # Dependency for FastAPI
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-# Database health check
-def check_db_health() -> bool:
+# Database health check (cached briefly so probe traffic doesn't drain the pool)
+HEALTH_CACHE_TTL = 5.0
+_health_cache = (0.0, False)
+
+async def check_db_health() -> bool:
+    global _health_cache
+    checked_at, healthy = _health_cache
+    now = time.monotonic()
+    if checked_at and now - checked_at < HEALTH_CACHE_TTL:
+        return healthy
+
     try:
-        db = SessionLocal()
-        db.execute("SELECT 1")
-        db.close()
-        return True
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+        healthy = True
     except Exception:
-        return False
+        healthy = False
+
+    _health_cache = (now, healthy)
+    return healthy
@@ -1,45 +1,75 @@
-from fastapi import FastAPI, Depends, HTTPException, Request, status
+from fastapi import FastAPI, Depends, HTTPException, Request, status, __version__ as fastapi_version
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel, Field
 from typing import Optional
+from contextlib import asynccontextmanager
+import asyncio
+import hmac
+import logging
+import orjson
 import structlog
 import time
 from datetime import datetime
 
-from .config import settings
-from .database import get_db, create_tables, check_db_health
+from .config import settings, get_settings, Settings
+from .database import get_db, create_tables, check_db_health, engine
 from .otp_service import EnterpriseOTPService, ClientOTP
+from .audit import audit_log_writer, stop_audit_log_writer
 
-# Initialize logging
+# Initialize logging (level filtering happens in the bound logger, before any processor runs)
 structlog.configure(
     processors=[
-        structlog.stdlib.filter_by_level,
-        structlog.stdlib.add_logger_name,
-        structlog.stdlib.add_log_level,
-        structlog.stdlib.PositionalArgumentsFormatter(),
-        structlog.processors.TimeStamper(fmt="iso"),
-        structlog.processors.StackInfoRenderer(),
+        structlog.processors.add_log_level,
+        structlog.processors.TimeStamper(fmt="iso", utc=True),
         structlog.processors.format_exc_info,
-        structlog.processors.UnicodeDecoder(),
-        structlog.processors.JSONRenderer()
+        structlog.processors.JSONRenderer(serializer=orjson.dumps)
     ],
     context_class=dict,
-    logger_factory=structlog.stdlib.LoggerFactory(),
-    wrapper_class=structlog.stdlib.BoundLogger,
+    logger_factory=structlog.BytesLoggerFactory(),
+    wrapper_class=structlog.make_filtering_bound_logger(logging.DEBUG if settings.debug else logging.INFO),
     cache_logger_on_first_use=True,
 )
 
 logger = structlog.get_logger()
 
+# Application lifespan
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Initialize database, perform startup checks and run the audit writer"""
+    logger.info("Starting OTP Service", version="1.0.0", environment=settings.environment)
+    await create_tables()
+    
+    if not await check_db_health():
+        logger.error("Database health check failed")
+        raise Exception("Database connection failed")
+    
+    audit_task = asyncio.create_task(audit_log_writer())
+    
+    logger.info("OTP Service started successfully")
+    yield
+    
+    await stop_audit_log_writer(audit_task)
+    await engine.dispose()
+
+# FastAPI 0.131+ serializes response_model routes straight to JSON bytes via Pydantic
+# and deprecates ORJSONResponse; only older releases need it as the default class
+_response_kwargs = (
+    {} if tuple(int(p) for p in fastapi_version.split(".")[:2]) >= (0, 131)
+    else {"default_response_class": ORJSONResponse}
+)
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Enterprise OTP Service",
     description="Production-ready TOTP authentication service",
     version="1.0.0",
     docs_url="/docs" if settings.debug else None,
-    redoc_url="/redoc" if settings.debug else None
+    redoc_url="/redoc" if settings.debug else None,
+    lifespan=lifespan,
+    **_response_kwargs
 )
 
 # CORS middleware
@@ -76,32 +106,21 @@ class APIResponse(BaseModel):
     data: Optional[dict] = None
 
 # Authentication middleware
+_API_KEY_BYTES = settings.api_key.encode()
+
 async def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    if not settings.api_key or credentials.credentials != settings.api_key:
+    if not _API_KEY_BYTES or not hmac.compare_digest(credentials.credentials.encode(), _API_KEY_BYTES):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid API key"
         )
     return credentials
 
-# Startup event
-@app.on_event("startup")
-async def startup_event():
-    """Initialize database and perform startup checks"""
-    logger.info("Starting OTP Service", version="1.0.0", environment=settings.environment)
-    create_tables()
-    
-    if not check_db_health():
-        logger.error("Database health check failed")
-        raise Exception("Database connection failed")
-    
-    logger.info("OTP Service started successfully")
-
 # Health check endpoint
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
     """Health check endpoint for monitoring"""
-    db_status = "healthy" if check_db_health() else "unhealthy"
+    db_status = "healthy" if await check_db_health() else "unhealthy"
     
     return HealthResponse(
         status="healthy" if db_status == "healthy" else "unhealthy",
@@ -115,14 +134,14 @@ async def health_check():
 async def register_device(
     request: Request,
     device_data: DeviceRegistration,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     credentials: HTTPAuthorizationCredentials = Depends(verify_api_key)
 ):
     """Register a new device for OTP generation"""
     start_time = time.time()
     
     try:
-        result = otp_service.register_device(
+        result = await otp_service.register_device(
             device_id=device_data.device_id,
             user_id=device_data.user_id,
             db=db
@@ -162,7 +181,7 @@ async def register_device(
 async def verify_otp(
     request: Request,
     otp_data: OTPVerification,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     credentials: HTTPAuthorizationCredentials = Depends(verify_api_key)
 ):
     """Verify an OTP for a registered device"""
@@ -170,7 +189,7 @@ async def verify_otp(
     client_ip = request.client.host if request.client else "unknown"
     
     try:
-        result = otp_service.verify_otp(
+        result = await otp_service.verify_otp(
             device_id=otp_data.device_id,
             otp=otp_data.otp,
             db=db,
@@ -208,12 +227,12 @@ async def verify_otp(
 @app.post("/api/v1/devices/{device_id}/deactivate", response_model=APIResponse)
 async def deactivate_device(
     device_id: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     credentials: HTTPAuthorizationCredentials = Depends(verify_api_key)
 ):
     """Deactivate a device"""
     try:
-        result = otp_service.deactivate_device(device_id=device_id, db=db)
+        result = await otp_service.deactivate_device(device_id=device_id, db=db)
         
         if "error" in result:
             raise HTTPException(status_code=400, detail=result["error"])
@@ -233,9 +252,9 @@ async def deactivate_device(
 
 # Test endpoint (only in debug mode)
 @app.post("/api/v1/test/generate-otp")
-async def test_generate_otp(derived_key_b64: str):
+async def test_generate_otp(derived_key_b64: str, app_settings: Settings = Depends(get_settings)):
     """Test endpoint to generate OTP from derived key (debug only)"""
-    if not settings.debug:
+    if not app_settings.debug:
         raise HTTPException(status_code=404, detail="Not found")
     
     try:
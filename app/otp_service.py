@@ -1,37 +1,73 @@
 import hmac
 import hashlib
-import struct
 import time
 import secrets
 import base64
+from functools import lru_cache
 from typing import Optional
 from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
+from sqlalchemy import select, insert, update, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from cachetools import TTLCache
 from .database import get_db, Device, AuditLog
+from .audit import enqueue_audit_log
 from .config import settings
 import structlog
 
+try:
+    import redis
+    import redis.asyncio
+except ImportError:
+    redis = None
+
 logger = structlog.get_logger()
 
+# Shared Redis client for rate limiting, only when REDIS_URL is set (falls back to the audit table)
+redis_client = (
+    redis.asyncio.Redis.from_url(settings.redis_url, socket_connect_timeout=0.5, socket_timeout=0.5)
+    if redis is not None and settings.redis_url else None
+)
+
+# After a Redis failure, use the database for this long before trying Redis again
+REDIS_RETRY_AFTER = 30.0
+_redis_retry_at = 0.0
+
+def _redis_available() -> bool:
+    return redis_client is not None and time.monotonic() >= _redis_retry_at
+
+@lru_cache(maxsize=8192)
+def _derive(master_secret: bytes, device_id: str) -> bytes:
+    """Derive the per-device key (cached, the master secret is fixed at runtime)"""
+    return hmac.new(master_secret, device_id.encode(), hashlib.sha256).digest()
+
+# Active devices seen recently, so verification can skip the device lookup
+DEVICE_CACHE_SIZE = 100_000
+DEVICE_CACHE_TTL = 60
+
 class EnterpriseOTPService:
     def __init__(self):
         if not settings.master_secret:
             raise ValueError("MASTER_SECRET environment variable is required")
         self.master_secret = settings.master_secret.encode()
+        # OTP parameters are fixed at startup, keep them off the hot path
+        self._digits = settings.otp_digits
+        self._modulus = 10 ** settings.otp_digits
+        self._interval = settings.otp_interval
+        self._window = settings.otp_window
+        self._rate_limit = settings.rate_limit_requests
+        self._rate_window = settings.rate_limit_window
+        self._active_devices = TTLCache(maxsize=DEVICE_CACHE_SIZE, ttl=DEVICE_CACHE_TTL)
 
     def generate_derived_key(self, device_id: str) -> bytes:
         """Generate derived key unique to device"""
-        return hmac.new(
-            self.master_secret, 
-            device_id.encode(), 
-            hashlib.sha256
-        ).digest()
+        return _derive(self.master_secret, device_id)
 
-    def register_device(self, device_id: str, user_id: str, db: Session) -> dict:
+    async def register_device(self, device_id: str, user_id: str, db: AsyncSession) -> dict:
         """Register a new device and return derived key"""
+        now = datetime.utcnow()
         try:
             # Check if device already exists
-            existing_device = db.query(Device).filter(Device.device_id == device_id).first()
+            existing_device = await db.scalar(select(Device.device_id).where(Device.device_id == device_id))
             if existing_device:
                 logger.warning("Device already registered", device_id=device_id)
                 return {"error": "Device already registered"}
@@ -44,9 +80,8 @@ class EnterpriseOTPService:
             device = Device(
                 device_id=device_id,
                 user_id=user_id,
-                derived_key_hash=hashlib.sha256(derived_key).hexdigest(),
                 is_active=True,
-                created_at=datetime.utcnow()
+                created_at=now
             )
             db.add(device)
             
@@ -55,11 +90,11 @@ class EnterpriseOTPService:
                 device_id=device_id,
                 action="DEVICE_REGISTERED",
                 success=True,
-                timestamp=datetime.utcnow(),
+                timestamp=now,
                 ip_address="unknown"
             )
             db.add(audit_log)
-            db.commit()
+            await db.commit()
 
             logger.info("Device registered successfully", device_id=device_id, user_id=user_id)
             
@@ -70,32 +105,37 @@ class EnterpriseOTPService:
             }
 
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             logger.error("Failed to register device", device_id=device_id, error=str(e))
             return {"error": "Registration failed"}
 
-    def verify_otp(self, device_id: str, otp: int, db: Session, ip_address: str = "unknown") -> dict:
+    async def verify_otp(self, device_id: str, otp: int, db: AsyncSession, ip_address: str = "unknown") -> dict:
         """Verify OTP with enhanced security and logging"""
+        now = datetime.utcnow()
         try:
             # Check if device exists and is active
-            device = db.query(Device).filter(
-                Device.device_id == device_id,
-                Device.is_active == True
-            ).first()
-            
-            if not device:
-                self._log_verification(db, device_id, "INVALID_DEVICE", False, ip_address)
-                return {"valid": False, "error": "Device not found or inactive"}
-
-            # Check rate limiting (basic implementation)
-            recent_attempts = db.query(AuditLog).filter(
-                AuditLog.device_id == device_id,
-                AuditLog.action == "OTP_VERIFICATION",
-                AuditLog.timestamp > datetime.utcnow() - timedelta(minutes=5)
-            ).count()
-
-            if recent_attempts > 10:
-                self._log_verification(db, device_id, "RATE_LIMITED", False, ip_address)
+            if device_id not in self._active_devices:
+                device = await db.scalar(
+                    select(Device.device_id).where(
+                        Device.device_id == device_id,
+                        Device.is_active == True
+                    )
+                )
+
+                if not device:
+                    self._log_verification(device_id, "INVALID_DEVICE", False, ip_address, now)
+                    return {"valid": False, "error": "Device not found or inactive"}
+                self._active_devices[device_id] = True
+
+            # Check rate limiting; without Redis the attempt is committed before counting,
+            # so concurrent requests for the same device always see each other
+            attempt_id = None
+            rate_limited = await self._redis_rate_limited(device_id)
+            if rate_limited is None:
+                attempt_id = await self._record_attempt(device_id, ip_address, now, db)
+                rate_limited = await self._db_rate_limited(device_id, now, db)
+            if rate_limited:
+                await self._log_result(db, attempt_id, device_id, "RATE_LIMITED", False, ip_address, now)
                 return {"valid": False, "error": "Rate limit exceeded"}
 
             # Generate derived key and verify OTP
@@ -104,12 +144,23 @@ class EnterpriseOTPService:
 
             # Update device last used
             if is_valid:
-                device.last_used = datetime.utcnow()
-                device.usage_count += 1
+                result = await db.execute(
+                    update(Device)
+                    .where(Device.device_id == device_id, Device.is_active == True)
+                    .values(last_used=now, usage_count=Device.usage_count + 1)
+                )
+                if result.rowcount == 0:
+                    # Deactivated since it was cached (possibly by another worker)
+                    self._active_devices.pop(device_id, None)
+                    await self._log_result(db, attempt_id, device_id, "INVALID_DEVICE", False, ip_address, now)
+                    return {"valid": False, "error": "Device not found or inactive"}
+                if attempt_id is not None:
+                    await db.execute(update(AuditLog).where(AuditLog.id == attempt_id).values(success=True))
+                await db.commit()
 
-            # Log verification attempt
-            self._log_verification(db, device_id, "OTP_VERIFICATION", is_valid, ip_address)
-            db.commit()
+            # Log verification attempt (the database limiter has already stored it)
+            if attempt_id is None:
+                self._log_verification(device_id, "OTP_VERIFICATION", is_valid, ip_address, now)
 
             logger.info("OTP verification completed", 
                        device_id=device_id, 
@@ -119,71 +170,137 @@ class EnterpriseOTPService:
             return {"valid": is_valid}
 
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             logger.error("OTP verification failed", device_id=device_id, error=str(e))
             return {"valid": False, "error": "Verification failed"}
 
+    def _recent_attempts(self, device_id: str, now: datetime):
+        """Count recent verification attempts, only scanning enough rows to trip the limit"""
+        recent = select(AuditLog.id).where(
+            AuditLog.device_id == device_id,
+            AuditLog.action == "OTP_VERIFICATION",
+            AuditLog.timestamp > now - timedelta(seconds=self._rate_window)
+        ).limit(self._rate_limit + 1).subquery()
+        return select(func.count()).select_from(recent).scalar_subquery()
+
+    async def _redis_rate_limited(self, device_id: str) -> Optional[bool]:
+        """Allow RATE_LIMIT_REQUESTS verifications per device per RATE_LIMIT_WINDOW seconds,
+        counting the current attempt, with a fixed-window counter in Redis. Returns None
+        when Redis is not in use, so the caller falls back to the audit table."""
+        global _redis_retry_at
+        if not _redis_available():
+            return None
+        try:
+            key = f"rl:{device_id}:{int(time.time() // self._rate_window)}"
+            attempts = await redis_client.incr(key)
+            if attempts == 1:
+                await redis_client.expire(key, self._rate_window)
+            return attempts > self._rate_limit
+        except redis.RedisError as e:
+            _redis_retry_at = time.monotonic() + REDIS_RETRY_AFTER
+            logger.warning("Redis rate limit unavailable, using database",
+                           error=str(e), retry_after=REDIS_RETRY_AFTER)
+            return None
+
+    async def _record_attempt(self, device_id: str, ip_address: str, now: datetime, db: AsyncSession) -> int:
+        """Commit this attempt's audit row (as failed until proven otherwise) and return its id"""
+        result = await db.execute(
+            insert(AuditLog).values(
+                device_id=device_id,
+                action="OTP_VERIFICATION",
+                success=False,
+                timestamp=now,
+                ip_address=ip_address
+            )
+        )
+        await db.commit()
+        return result.inserted_primary_key[0]
+
+    async def _db_rate_limited(self, device_id: str, now: datetime, db: AsyncSession) -> bool:
+        """Same limit as Redis, counted from the audit table including the attempt just recorded"""
+        return await db.scalar(select(self._recent_attempts(device_id, now))) > self._rate_limit
+
+    async def _log_result(self, db: AsyncSession, attempt_id: Optional[int], device_id: str,
+                          action: str, success: bool, ip_address: str, now: datetime):
+        """Log a rejected attempt, relabelling the row the database limiter already stored"""
+        if attempt_id is None:
+            self._log_verification(device_id, action, success, ip_address, now)
+            return
+        await db.execute(update(AuditLog).where(AuditLog.id == attempt_id).values(action=action, success=success))
+        await db.commit()
+
     def _verify_totp(self, secret_key: bytes, otp: int) -> bool:
         """Time-based OTP verification with window tolerance"""
-        current_time_step = int(time.time() // settings.otp_interval)
+        current_time_step = int(time.time() // self._interval)
+        # Key the HMAC once, each time step works on a copy of it
+        hmac_template = hmac.new(secret_key, digestmod=hashlib.sha1)
         
-        # Check OTP in time window +/- window to allow clock drift
-        for offset in range(-settings.otp_window, settings.otp_window + 1):
-            time_step = current_time_step + offset
-            if self._generate_otp(secret_key, time_step) == otp:
-                return True
-        return False
-
-    def _generate_otp(self, secret_key: bytes, time_step: int) -> int:
-        """Generate TOTP using HMAC-SHA1"""
+        # Build every candidate in the +/- window up front to allow clock drift
+        candidates = frozenset(
+            self._generate_otp(hmac_template, current_time_step + offset)
+            for offset in range(-self._window, self._window + 1)
+        )
+
+        # Constant-time compare against all candidates, no early exit
+        digits = self._digits
+        target = str(otp).zfill(digits)
+        matches = [hmac.compare_digest(target, str(c).zfill(digits)) for c in candidates]
+        return any(matches)
+
+    def _generate_otp(self, hmac_template: hmac.HMAC, time_step: int) -> int:
+        """Generate TOTP using HMAC-SHA1 from a pre-keyed HMAC"""
         # Pack time step into bytes
-        msg = struct.pack(">Q", time_step)
+        msg = time_step.to_bytes(8, "big")
         # HMAC-SHA1 with derived key
-        hmac_hash = hmac.new(secret_key, msg, hashlib.sha1).digest()
+        h = hmac_template.copy()
+        h.update(msg)
+        hmac_hash = h.digest()
         # Dynamic truncation
         offset = hmac_hash[-1] & 0x0F
         truncated_hash = hmac_hash[offset:offset + 4]
-        code_int = struct.unpack(">I", truncated_hash)[0] & 0x7FFFFFFF
+        code_int = int.from_bytes(truncated_hash, "big") & 0x7FFFFFFF
         # Return code modulo digits
-        return code_int % (10 ** settings.otp_digits)
-
-    def _log_verification(self, db: Session, device_id: str, action: str, success: bool, ip_address: str):
-        """Log verification attempt"""
-        audit_log = AuditLog(
-            device_id=device_id,
-            action=action,
-            success=success,
-            timestamp=datetime.utcnow(),
-            ip_address=ip_address
-        )
-        db.add(audit_log)
+        return code_int % self._modulus
 
-    def deactivate_device(self, device_id: str, db: Session) -> dict:
+    def _log_verification(self, device_id: str, action: str, success: bool, ip_address: str, now: datetime):
+        """Log verification attempt (written in the background by the audit writer)"""
+        enqueue_audit_log({
+            "device_id": device_id,
+            "action": action,
+            "success": success,
+            "timestamp": now,
+            "ip_address": ip_address
+        })
+
+    async def deactivate_device(self, device_id: str, db: AsyncSession) -> dict:
         """Deactivate a device"""
+        now = datetime.utcnow()
         try:
-            device = db.query(Device).filter(Device.device_id == device_id).first()
-            if not device:
+            result = await db.execute(
+                update(Device)
+                .where(Device.device_id == device_id)
+                .values(is_active=False, deactivated_at=now)
+            )
+            if result.rowcount == 0:
                 return {"error": "Device not found"}
-
-            device.is_active = False
-            device.deactivated_at = datetime.utcnow()
             
             # Log deactivation
             audit_log = AuditLog(
                 device_id=device_id,
                 action="DEVICE_DEACTIVATED",
                 success=True,
-                timestamp=datetime.utcnow(),
+                timestamp=now,
                 ip_address="system"
             )
             db.add(audit_log)
-            db.commit()
+            await db.commit()
+            self._active_devices.pop(device_id, None)
 
             logger.info("Device deactivated", device_id=device_id)
             return {"message": "Device deactivated successfully"}
 
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             logger.error("Failed to deactivate device", device_id=device_id, error=str(e))
             return {"error": "Deactivation failed"}
 
@@ -192,13 +309,18 @@ class ClientOTP:
     """Client-side OTP generator (for testing/simulation)"""
     def __init__(self, derived_key_b64: str):
         self.derived_key = base64.b64decode(derived_key_b64)
+        self._hmac_template = hmac.new(self.derived_key, digestmod=hashlib.sha1)
+        self._modulus = 10 ** settings.otp_digits
+        self._interval = settings.otp_interval
 
     def generate_otp(self) -> int:
         """Generate current TOTP"""
-        time_step = int(time.time() // settings.otp_interval)
-        msg = struct.pack(">Q", time_step)
-        hmac_hash = hmac.new(self.derived_key, msg, hashlib.sha1).digest()
+        time_step = int(time.time() // self._interval)
+        msg = time_step.to_bytes(8, "big")
+        h = self._hmac_template.copy()
+        h.update(msg)
+        hmac_hash = h.digest()
         offset = hmac_hash[-1] & 0x0F
         truncated_hash = hmac_hash[offset:offset + 4]
-        code_int = struct.unpack(">I", truncated_hash)[0] & 0x7FFFFFFF
-        return code_int % (10 ** settings.otp_digits)
+        code_int = int.from_bytes(truncated_hash, "big") & 0x7FFFFFFF
+        return code_int % self._modulus
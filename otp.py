@@ -1,6 +1,4 @@
 import hmac
-import hashlib
-import struct
 import time
 
 # -------------------------
@@ -12,7 +10,7 @@ class Server:
 
     def generate_derived_key(self, device_id):
         # Generate derived key unique to device
-        return hmac.new(self.master_secret, device_id, hashlib.sha256).digest()
+        return hmac.digest(self.master_secret, device_id, "sha256")
 
     def verify_otp(self, device_id, otp, digits=6, interval=30, window=1):
         # Regenerate derived key for device
@@ -28,13 +26,13 @@ class Server:
 
     def _generate_otp(self, secret_key, time_step, digits):
         # Pack time step into bytes
-        msg = struct.pack(">Q", time_step)
+        msg = time_step.to_bytes(8, "big")
         # HMAC-SHA1 with derived key
-        hmac_hash = hmac.new(secret_key, msg, hashlib.sha1).digest()
+        hmac_hash = hmac.digest(secret_key, msg, "sha1")
         # Dynamic truncation
         offset = hmac_hash[-1] & 0x0F
         truncated_hash = hmac_hash[offset:offset + 4]
-        code_int = struct.unpack(">I", truncated_hash)[0] & 0x7FFFFFFF
+        code_int = int.from_bytes(truncated_hash, "big") & 0x7FFFFFFF
         # Return code modulo digits
         return code_int % (10 ** digits)
 
@@ -47,11 +45,11 @@ class Client:
 
     def generate_otp(self, digits=6, interval=30):
         time_step = int(time.time() // interval)
-        msg = struct.pack(">Q", time_step)
-        hmac_hash = hmac.new(self.derived_key, msg, hashlib.sha1).digest()
+        msg = time_step.to_bytes(8, "big")
+        hmac_hash = hmac.digest(self.derived_key, msg, "sha1")
         offset = hmac_hash[-1] & 0x0F
         truncated_hash = hmac_hash[offset:offset + 4]
-        code_int = struct.unpack(">I", truncated_hash)[0] & 0x7FFFFFFF
+        code_int = int.from_bytes(truncated_hash, "big") & 0x7FFFFFFF
         return code_int % (10 ** digits)
 
 # -------------------------
@@ -6,14 +6,13 @@ Run this after deploying to Render.com
 
 import requests
 import hmac
-import hashlib
-import struct
 import time
 import base64
 
 # Configuration
 RENDER_URL = "https://otp-test-YOUR-ID.onrender.com"  # Replace with your actual URL
 API_KEY = "UkFPS1EXdV8SmopIby5TvY2kCTsu228c"  # Your generated API key
+OTP_MODULUS = 10 ** 6  # 6 digits
 
 def test_service_quick():
     """Quick test of the OTP service"""
@@ -75,12 +74,12 @@ def test_service_quick():
     def generate_otp(derived_key_b64):
         derived_key = base64.b64decode(derived_key_b64)
         time_step = int(time.time() // 30)
-        msg = struct.pack(">Q", time_step)
-        hmac_hash = hmac.new(derived_key, msg, hashlib.sha1).digest()
+        msg = time_step.to_bytes(8, "big")
+        hmac_hash = hmac.digest(derived_key, msg, "sha1")
         offset = hmac_hash[-1] & 0x0F
         truncated_hash = hmac_hash[offset:offset + 4]
-        code_int = struct.unpack(">I", truncated_hash)[0] & 0x7FFFFFFF
-        return code_int % (10 ** 6)
+        code_int = int.from_bytes(truncated_hash, "big") & 0x7FFFFFFF
+        return code_int % OTP_MODULUS
     
     otp = generate_otp(derived_key)
     print(f"🔢 Generated OTP: {otp:06d}")
@@ -1,16 +1,28 @@
 # Change the import to work with uvicorn command
-from fastapi import FastAPI, HTTPException, Depends, Request, status
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, Field
 import hmac
-import hashlib
-import struct
+import logging
 import time
 import base64
 import os
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timezone
 from typing import Optional, Dict, Any
 
+logger = logging.getLogger(__name__)
+
+# HMAC sites use hmac.digest / string digest names so OpenSSL's one-shot path is taken
+try:
+    import _hashlib
+    HMAC_OPENSSL = {"sha1", "sha256"} <= set(_hashlib.openssl_md_meth_names)
+except ImportError:
+    HMAC_OPENSSL = False
+
+if not HMAC_OPENSSL:
+    logger.warning("OpenSSL-backed hashlib not available, HMAC will use the slower pure-Python path")
+
 # Configuration
 API_KEY = os.getenv("API_KEY", "UkFPS1EXdV8SmopIby5TvY2kCTsu228c")
 MASTER_SECRET = os.getenv("MASTER_SECRET", "cxxH4qNRyLeePT49yRJev1kRdF1Cu0jA1e8FA2sGQZw")
@@ -19,9 +31,43 @@ MASTER_SECRET = os.getenv("MASTER_SECRET", "cxxH4qNRyLeePT49yRJev1kRdF1Cu0jA1e8F
 app = FastAPI(title="Simple OTP Service", version="1.0.0")
 security = HTTPBearer()
 
+OTP_MODULUS = 10 ** 6
+
+# Second-granular ISO timestamp, rebuilt at most once per second
+_ts_cache = [0, ""]
+
+def now_iso() -> str:
+    t = int(time.time())
+    if t != _ts_cache[0]:
+        _ts_cache[0] = t
+        _ts_cache[1] = datetime.fromtimestamp(t, tz=timezone.utc).isoformat()
+    return _ts_cache[1]
+
+def format_ns(ns: Optional[int]) -> Optional[str]:
+    """Render a time.time_ns() timestamp as ISO 8601 (for display only)"""
+    if ns is None:
+        return None
+    return datetime.fromtimestamp(ns / 1e9, tz=timezone.utc).isoformat()
+
+# Device record (slotted, one per registered device)
+class Device:
+    __slots__ = ("user_id", "created_at", "is_active", "deactivated_at", "hmac_template")
+
+    def __init__(self, user_id: str, created_at: int, is_active: bool = True,
+                 deactivated_at: Optional[int] = None, hmac_template: Optional[hmac.HMAC] = None):
+        self.user_id = user_id
+        self.created_at = created_at
+        self.is_active = is_active
+        self.deactivated_at = deactivated_at
+        # Keyed once at registration, copied per time step on verify
+        self.hmac_template = hmac_template
+
+# Key material never leaves the process
+DEVICE_PRIVATE_FIELDS = {"hmac_template"}
+
 # Simple in-memory storage
-devices_db = {}
-audit_logs = []
+devices_db: Dict[str, Device] = {}
+audit_logs = deque(maxlen=10000)  # Only the most recent entries are kept
 
 # Pydantic models
 class DeviceRegistration(BaseModel):
@@ -42,35 +88,44 @@ class SimpleOTPService:
     def __init__(self, master_secret: str):
         self.master_secret = master_secret.encode()
     
-    def generate_derived_key(self, device_id: str) -> bytes:
-        return hmac.new(self.master_secret, device_id.encode(), hashlib.sha256).digest()
+    def generate_derived_key(self, device_id: bytes) -> bytes:
+        return hmac.digest(self.master_secret, device_id, "sha256")
     
-    def generate_otp(self, secret_key: bytes, digits: int = 6, interval: int = 30) -> int:
+    def generate_otp(self, secret_key: bytes, interval: int = 30) -> int:
         time_step = int(time.time() // interval)
-        msg = struct.pack(">Q", time_step)
-        hmac_hash = hmac.new(secret_key, msg, hashlib.sha1).digest()
+        msg = time_step.to_bytes(8, "big")
+        hmac_hash = hmac.digest(secret_key, msg, "sha1")
         offset = hmac_hash[-1] & 0x0F
         truncated_hash = hmac_hash[offset:offset + 4]
-        code_int = struct.unpack(">I", truncated_hash)[0] & 0x7FFFFFFF
-        return code_int % (10 ** digits)
+        code_int = int.from_bytes(truncated_hash, "big") & 0x7FFFFFFF
+        return code_int % OTP_MODULUS
     
-    def verify_otp(self, device_id: str, otp: int, window: int = 1) -> bool:
-        derived_key = self.generate_derived_key(device_id)
+    def verify_otp(self, device_id: str, otp: int, window: int = 1,
+                   hmac_template: Optional[hmac.HMAC] = None) -> bool:
+        if hmac_template is None:
+            hmac_template = hmac.new(self.generate_derived_key(device_id.encode()), None, "sha1")
         current_time_step = int(time.time() // 30)
+        target = f"{otp:06d}".encode()
         
-        for offset in range(-window, window + 1):
-            time_step = current_time_step + offset
-            if self.generate_otp_at_time(derived_key, time_step) == otp:
+        # Current step first (synced clocks), then the drift window on either side
+        for offset in (0, *range(-window, 0), *range(1, window + 1)):
+            h = hmac_template.copy()
+            h.update((current_time_step + offset).to_bytes(8, "big"))
+            hmac_hash = h.digest()
+            trunc_offset = hmac_hash[-1] & 0x0F
+            code_int = int.from_bytes(hmac_hash[trunc_offset:trunc_offset + 4], "big") & 0x7FFFFFFF
+            candidate = f"{code_int % OTP_MODULUS:06d}".encode()
+            if hmac.compare_digest(candidate, target):
                 return True
         return False
     
     def generate_otp_at_time(self, secret_key: bytes, time_step: int) -> int:
-        msg = struct.pack(">Q", time_step)
-        hmac_hash = hmac.new(secret_key, msg, hashlib.sha1).digest()
+        msg = time_step.to_bytes(8, "big")
+        hmac_hash = hmac.digest(secret_key, msg, "sha1")
         offset = hmac_hash[-1] & 0x0F
         truncated_hash = hmac_hash[offset:offset + 4]
-        code_int = struct.unpack(">I", truncated_hash)[0] & 0x7FFFFFFF
-        return code_int % (10 ** 6)
+        code_int = int.from_bytes(truncated_hash, "big") & 0x7FFFFFFF
+        return code_int % OTP_MODULUS
 
 otp_service = SimpleOTPService(MASTER_SECRET)
 
@@ -89,7 +144,7 @@ async def root():
 async def health_check():
     return {
         "status": "healthy",
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": now_iso(),
         "version": "1.0.0",
         "database": "memory"
     }
@@ -104,20 +159,23 @@ async def register_device(
         if device_data.device_id in devices_db:
             raise HTTPException(status_code=400, detail="Device already registered")
         
-        derived_key = otp_service.generate_derived_key(device_data.device_id)
+        device_id_bytes = device_data.device_id.encode()
+        derived_key = otp_service.generate_derived_key(device_id_bytes)
         derived_key_b64 = base64.b64encode(derived_key).decode()
         
-        devices_db[device_data.device_id] = {
-            "user_id": device_data.user_id,
-            "created_at": datetime.utcnow().isoformat(),
-            "is_active": True
-        }
+        devices_db[device_data.device_id] = Device(
+            user_id=device_data.user_id,
+            created_at=time.time_ns(),
+            is_active=True,
+            deactivated_at=None,
+            hmac_template=hmac.new(derived_key, None, "sha1")
+        )
         
         audit_logs.append({
             "device_id": device_data.device_id,
             "action": "DEVICE_REGISTERED",
             "success": True,
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": time.time_ns()
         })
         
         return APIResponse(
@@ -145,16 +203,16 @@ async def verify_otp(
             raise HTTPException(status_code=400, detail="Device not found")
         
         device = devices_db[otp_data.device_id]
-        if not device["is_active"]:
+        if not device.is_active:
             raise HTTPException(status_code=400, detail="Device is inactive")
         
-        is_valid = otp_service.verify_otp(otp_data.device_id, otp_data.otp)
+        is_valid = otp_service.verify_otp(otp_data.device_id, otp_data.otp, hmac_template=device.hmac_template)
         
         audit_logs.append({
             "device_id": otp_data.device_id,
             "action": "OTP_VERIFICATION",
             "success": is_valid,
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": time.time_ns(),
             "ip_address": request.client.host if request.client else "unknown"
         })
         
@@ -178,14 +236,14 @@ async def deactivate_device(
         if device_id not in devices_db:
             raise HTTPException(status_code=400, detail="Device not found")
         
-        devices_db[device_id]["is_active"] = False
-        devices_db[device_id]["deactivated_at"] = datetime.utcnow().isoformat()
+        devices_db[device_id].is_active = False
+        devices_db[device_id].deactivated_at = time.time_ns()
         
         audit_logs.append({
             "device_id": device_id,
             "action": "DEVICE_DEACTIVATED",
             "success": True,
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": time.time_ns()
         })
         
         return APIResponse(
@@ -201,7 +259,14 @@ async def deactivate_device(
 @app.get("/api/v1/debug/devices")
 async def list_devices(credentials: HTTPAuthorizationCredentials = Depends(verify_api_key)):
     """List all devices (debug only)"""
-    return {"devices": devices_db, "audit_logs": audit_logs[-10:]}  # Last 10 logs
+    devices = {}
+    for device_id, device in devices_db.items():
+        record = {k: getattr(device, k) for k in Device.__slots__ if k not in DEVICE_PRIVATE_FIELDS}
+        record["created_at"] = format_ns(device.created_at)
+        record["deactivated_at"] = format_ns(device.deactivated_at)
+        devices[device_id] = record
+    logs = [{**log, "timestamp": format_ns(log["timestamp"])} for log in list(audit_logs)[-10:]]  # Last 10 logs
+    return {"devices": devices, "audit_logs": logs}
 
 # Remove the main section since uvicorn will run the app directly
 # App is ready to be run with: uvicorn simple_app:app --host 0.0.0.0 --port $PORT
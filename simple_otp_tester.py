@@ -4,22 +4,22 @@ Use this to generate OTPs for manual testing
 """
 
 import hmac
-import hashlib
-import struct
 import time
 import base64
 
-def generate_otp_from_key(derived_key_b64: str, digits: int = 6, interval: int = 30) -> int:
+OTP_MODULUS = 10 ** 6  # 6 digits
+
+def generate_otp_from_key(derived_key_b64: str, interval: int = 30) -> int:
     """Generate OTP from base64 derived key"""
     try:
         derived_key = base64.b64decode(derived_key_b64)
         time_step = int(time.time() // interval)
-        msg = struct.pack(">Q", time_step)
-        hmac_hash = hmac.new(derived_key, msg, hashlib.sha1).digest()
+        msg = time_step.to_bytes(8, "big")
+        hmac_hash = hmac.digest(derived_key, msg, "sha1")
         offset = hmac_hash[-1] & 0x0F
         truncated_hash = hmac_hash[offset:offset + 4]
-        code_int = struct.unpack(">I", truncated_hash)[0] & 0x7FFFFFFF
-        return code_int % (10 ** digits)
+        code_int = int.from_bytes(truncated_hash, "big") & 0x7FFFFFFF
+        return code_int % OTP_MODULUS
     except Exception as e:
         print(f"Error generating OTP: {e}")
         return None
@@ -1,12 +1,12 @@
 import requests
 import hmac
-import hashlib
-import struct
 import time
 import base64
 import json
 from typing import Dict, Any
 
+OTP_MODULUS = 10 ** 6  # 6 digits
+
 class OTPTester:
     def __init__(self, base_url: str, api_key: str):
         self.base_url = base_url.rstrip('/')
@@ -79,12 +79,12 @@ class OTPTester:
         """Generate OTP locally using derived key"""
         derived_key = base64.b64decode(derived_key_b64)
         time_step = int(time.time() // 30)  # 30 second interval
-        msg = struct.pack(">Q", time_step)
-        hmac_hash = hmac.new(derived_key, msg, hashlib.sha1).digest()
+        msg = time_step.to_bytes(8, "big")
+        hmac_hash = hmac.digest(derived_key, msg, "sha1")
         offset = hmac_hash[-1] & 0x0F
         truncated_hash = hmac_hash[offset:offset + 4]
-        code_int = struct.unpack(">I", truncated_hash)[0] & 0x7FFFFFFF
-        return code_int % (10 ** 6)  # 6 digits
+        code_int = int.from_bytes(truncated_hash, "big") & 0x7FFFFFFF
+        return code_int % OTP_MODULUS
     
     def verify_otp(self, device_id: str, otp: int) -> Dict[str, Any]:
         """Verify OTP with the server"""